@@ -4,47 +4,123 @@ Adaptive Clinical Decision Simulator - Main Application
 FastAPI entry point with CORS, error handling, and router registration.
 """
 
-from fastapi import FastAPI, Request, status
+from fastapi import FastAPI, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, HTMLResponse
 from fastapi.exceptions import RequestValidationError
 from contextlib import asynccontextmanager
+import asyncio
 import logging
 import time
-from typing import Dict
+import asyncpg
+import openai
+import orjson
+import structlog
 
 from routers import documents, simulator, grading
-from utils.config import settings
+from utils.config import settings, validate_configuration
 
-# Configure logging
+# Use the uvloop event loop even when the app is run outside uvicorn.run
+# (tests, scripts) — uvicorn itself is told to use it below.
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
+# Configure logging: structlog with an orjson renderer writing bytes.
+# Calls below the active level are a no-op method call, and message
+# rendering is deferred until after filtering, so nothing on the request
+# path assembles strings eagerly. Stdlib basicConfig stays for the
+# service modules that still use logging.getLogger.
 logging.basicConfig(
     level=getattr(logging, settings.LOG_LEVEL),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
-logger = logging.getLogger(__name__)
+
+structlog.configure(
+    processors=[
+        structlog.contextvars.merge_contextvars,
+        structlog.processors.add_log_level,
+        structlog.processors.TimeStamper(fmt="iso"),
+        structlog.processors.JSONRenderer(serializer=orjson.dumps)
+    ],
+    wrapper_class=structlog.make_filtering_bound_logger(getattr(logging, settings.LOG_LEVEL)),
+    logger_factory=structlog.BytesLoggerFactory(),
+    cache_logger_on_first_use=True
+)
+logger = structlog.get_logger(__name__)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Startup and shutdown events"""
     # Startup
-    logger.info(f"Starting {settings.APP_NAME} v{settings.APP_VERSION}")
-    logger.info(f"OpenAI Org ID: {settings.OPENAI_ORG_ID}")
-    logger.info(f"Debug mode: {settings.DEBUG}")
+    logger.info("starting_application", app=settings.APP_NAME, version=settings.APP_VERSION)
+    logger.info("openai_org", org_id=settings.OPENAI_ORG_ID)
+    logger.info("debug_mode", enabled=settings.DEBUG)
+
+    # Cross-field checks (weight sums, URL shapes) run here, not at import
+    # of config.py, so tooling and tests can import modules without a full
+    # environment; a misconfigured deployment still fails before serving
+    validate_configuration()
     
     # Verify database connection
     try:
-        from services.database import test_connection
+        from services.database import test_connection, get_pg_pool
         await test_connection()
-        logger.info("✓ Database connection successful")
+        logger.info("database_connected")
+        await get_pg_pool()
     except Exception as e:
-        logger.error(f"✗ Database connection failed: {e}")
+        logger.error("database_connection_failed", error=str(e))
         raise
-    
+
+    from utils.embedding import start_embedding_worker
+    await start_embedding_worker()
+
     yield
-    
+
     # Shutdown
-    logger.info("Shutting down application")
+    logger.info("shutting_down")
+    from utils.embedding import stop_embedding_worker
+    await stop_embedding_worker()
+    from utils.openai_client import close_openai_client
+    await close_openai_client()
+    from services.database import close_pg_pool
+    await close_pg_pool()
+
+
+# Request timing middleware (pure ASGI — BaseHTTPMiddleware would add an
+# extra anyio task and stream pair to every request)
+class TimingMiddleware:
+    """Track request processing time via an X-Process-Time header"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                process_time = time.perf_counter() - start_time
+                message["headers"].append(
+                    (b"x-process-time", f"{process_time:.3f}".encode())
+                )
+                if process_time > 5.0:
+                    logger.warning(
+                        "slow_request",
+                        method=scope["method"],
+                        path=scope["path"],
+                        seconds=round(process_time, 2)
+                    )
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
 
 
 # Initialize FastAPI app
@@ -54,6 +130,8 @@ app = FastAPI(
     description="RAG-powered adaptive clinical decision training for Hospitalists",
     docs_url="/api/docs" if settings.DEBUG else None,
     redoc_url="/api/redoc" if settings.DEBUG else None,
+    openapi_url="/openapi.json" if settings.DEBUG else None,
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
@@ -68,27 +146,33 @@ app.add_middleware(
 )
 
 
-# Request timing middleware
-@app.middleware("http")
-async def add_process_time_header(request: Request, call_next):
-    """Track request processing time"""
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
-    response.headers["X-Process-Time"] = str(round(process_time, 3))
-    
-    if process_time > 5.0:
-        logger.warning(f"Slow request: {request.method} {request.url.path} took {process_time:.2f}s")
-    
-    return response
+if settings.ENABLE_TIMING:
+    app.add_middleware(TimingMiddleware)
+
+
+# On-demand profiling (debug only): append ?profile=1 to any request to get
+# an HTML flamegraph of the async call stack instead of the response
+if settings.DEBUG:
+    from pyinstrument import Profiler
+
+    @app.middleware("http")
+    async def profile_request(request: Request, call_next):
+        """Profile a single request when ?profile=1 is passed"""
+        if request.query_params.get("profile"):
+            profiler = Profiler(interval=0.001, async_mode="enabled")
+            profiler.start()
+            await call_next(request)
+            profiler.stop()
+            return HTMLResponse(profiler.output_html())
+        return await call_next(request)
 
 
 # Exception handlers
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
     """Handle validation errors gracefully"""
-    logger.error(f"Validation error: {exc.errors()}")
-    return JSONResponse(
+    logger.error("validation_error", details=exc.errors())
+    return ORJSONResponse(
         status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
         content={
             "error": "Validation Error",
@@ -98,46 +182,108 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
     )
 
 
-@app.exception_handler(Exception)
-async def global_exception_handler(request: Request, exc: Exception):
-    """Catch-all exception handler"""
-    logger.error(f"Unhandled exception: {str(exc)}", exc_info=True)
-    
-    if settings.DEBUG:
-        error_detail = str(exc)
-    else:
-        error_detail = "An internal error occurred. Our team has been notified."
-    
-    return JSONResponse(
+# No bare-Exception handler: wrapping every endpoint in Python-level
+# exception machinery costs the common fast path, and Starlette's default
+# 500 response covers truly unknown errors. Only the failure classes the
+# app actually produces get handlers.
+@app.exception_handler(openai.APIError)
+async def openai_exception_handler(request: Request, exc: openai.APIError):
+    """Surface OpenAI failures as a 502 instead of a generic 500"""
+    logger.error("openai_api_error", error=str(exc))
+    return ORJSONResponse(
+        status_code=status.HTTP_502_BAD_GATEWAY,
+        content={
+            "error": "Upstream AI Error",
+            "message": str(exc) if settings.DEBUG else "The AI service is temporarily unavailable. Please retry."
+        }
+    )
+
+
+@app.exception_handler(asyncpg.PostgresError)
+async def database_exception_handler(request: Request, exc: asyncpg.PostgresError):
+    """Handle database errors from the asyncpg pool"""
+    logger.error("database_error", error=str(exc))
+    return ORJSONResponse(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         content={
-            "error": "Internal Server Error",
-            "message": error_detail
+            "error": "Database Error",
+            "message": str(exc) if settings.DEBUG else "An internal error occurred. Our team has been notified."
         }
     )
 
 
+# Constant system responses, serialized once at import — liveness probes
+# hit /health several times a second across replicas and shouldn't pay
+# for serialization (or allocate) each time.
+_HEALTH_BYTES = orjson.dumps({
+    "status": "healthy",
+    "version": settings.APP_VERSION,
+    "environment": "development" if settings.DEBUG else "production"
+})
+
+_ROOT_BYTES = orjson.dumps({
+    "app": settings.APP_NAME,
+    "version": settings.APP_VERSION,
+    "docs": "/api/docs" if settings.DEBUG else "Documentation disabled in production",
+    "health": "/health"
+})
+
+
 # Health check endpoint
 @app.get("/health", tags=["System"])
-async def health_check() -> Dict[str, str]:
+async def health_check() -> Response:
     """Simple health check endpoint for monitoring"""
-    return {
-        "status": "healthy",
-        "version": settings.APP_VERSION,
-        "environment": "development" if settings.DEBUG else "production"
-    }
+    return Response(
+        content=_HEALTH_BYTES,
+        media_type="application/json",
+        headers={"Cache-Control": "public, max-age=60"}
+    )
+
+
+# Readiness: unlike /health this actually pings the database, but the
+# result is cached for a few seconds so probe fan-out across replicas
+# can't stampede Supabase
+_READY_BYTES = orjson.dumps({"status": "ready"})
+_NOT_READY_BYTES = orjson.dumps({"status": "not ready"})
+_READY_CHECK_INTERVAL = 5.0
+
+_ready_state = {"checked_at": 0.0, "ok": False}
+_ready_lock = asyncio.Lock()
+
+
+@app.get("/readyz", tags=["System"])
+async def readiness_check() -> Response:
+    """Readiness check backed by a rate-limited database ping"""
+    now = time.perf_counter()
+
+    if now - _ready_state["checked_at"] > _READY_CHECK_INTERVAL:
+        # One ping at a time: concurrent probes arriving after the window
+        # expires wait for the in-flight check instead of stampeding
+        async with _ready_lock:
+            if now - _ready_state["checked_at"] > _READY_CHECK_INTERVAL:
+                from services.database import test_connection
+                _ready_state["ok"] = await test_connection()
+                _ready_state["checked_at"] = time.perf_counter()
+
+    if _ready_state["ok"]:
+        return Response(content=_READY_BYTES, media_type="application/json")
+
+    return Response(
+        content=_NOT_READY_BYTES,
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        media_type="application/json"
+    )
 
 
 # API info endpoint
 @app.get("/", tags=["System"])
-async def root() -> Dict[str, str]:
+async def root() -> Response:
     """Root endpoint with API information"""
-    return {
-        "app": settings.APP_NAME,
-        "version": settings.APP_VERSION,
-        "docs": "/api/docs" if settings.DEBUG else "Documentation disabled in production",
-        "health": "/health"
-    }
+    return Response(
+        content=_ROOT_BYTES,
+        media_type="application/json",
+        headers={"Cache-Control": "public, max-age=300"}
+    )
 
 
 # Register routers
@@ -167,35 +313,9 @@ if __name__ == "__main__":
         host="0.0.0.0",
         port=8000,
         reload=settings.DEBUG,
-        log_level=settings.LOG_LEVEL.lower()
+        log_level=settings.LOG_LEVEL.lower(),
+        loop="uvloop",
+        http="httptools",
+        workers=settings.WORKERS if not settings.DEBUG else 1,
+        access_log=settings.DEBUG
     )
-```
-
-**After pasting, click "Commit new file" at the bottom.**
-
----
-
-### File 2: `backend/requirements.txt`
-
-**Path:** `backend/requirements.txt`
-```
-fastapi==0.109.0
-uvicorn[standard]==0.27.0
-pydantic==2.5.3
-pydantic-settings==2.1.0
-openai==1.10.0
-langchain==0.1.6
-langchain-openai==0.0.5
-tiktoken==0.5.2
-pypdf==4.0.1
-python-multipart==0.0.6
-supabase==2.3.4
-psycopg2-binary==2.9.9
-pgvector==0.2.4
-numpy==1.26.3
-scikit-learn==1.4.0
-python-jose[cryptography]==3.3.0
-passlib[bcrypt]==1.7.4
-python-dotenv==1.0.0
-aiofiles==23.2.1
-tenacity==8.2.3
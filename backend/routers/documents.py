@@ -2,73 +2,67 @@
 Documents Router - PDF upload and management
 """
 
-from fastapi import APIRouter, UploadFile, File, HTTPException, Depends, Form
+from fastapi import APIRouter, BackgroundTasks, UploadFile, File, HTTPException, Depends, Form
 import logging
+import tempfile
 
-from models.schemas import DocumentResponse
 from routers.simulator import get_current_user
-from services.ingestion import ingest_document, validate_pdf
+from services.ingestion import create_pending_document, ingest_document, validate_pdf
 from services.database import get_supabase_client
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
-@router.post("/upload", response_model=DocumentResponse)
+@router.post("/upload", status_code=202)
 async def upload_document(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     title: str = Form(...),
     document_type: str = Form("guideline"),
     specialty: str = Form("hospitalist"),
     user_id: str = Depends(get_current_user)
 ):
-    """Upload and ingest a PDF document"""
+    """Upload a PDF document and ingest it in the background"""
     
     if not file.filename.lower().endswith('.pdf'):
         raise HTTPException(status_code=422, detail="Only PDF files are supported")
     
     try:
-        # Read file content
-        pdf_bytes = await file.read()
-        
+        # Spool the upload to disk past 8MB instead of buffering the whole
+        # PDF in memory per in-flight request
+        spool = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+        while chunk := await file.read(1024 * 1024):
+            spool.write(chunk)
+
+        file_size = spool.tell()
+        spool.seek(0)
+
         # Validate PDF
-        is_valid, error_msg = validate_pdf(pdf_bytes)
+        is_valid, error_msg = validate_pdf(spool)
         if not is_valid:
             raise HTTPException(status_code=422, detail=error_msg)
-        
-        logger.info(f"Uploading document: {title} ({len(pdf_bytes)} bytes)")
-        
-        # Ingest document
-        document_id = await ingest_document(
-            pdf_bytes=pdf_bytes,
+
+        logger.info(f"Uploading document: {title} ({file_size} bytes)")
+
+        # Create the row now, ingest after the response is sent — parsing,
+        # chunking and embedding a large PDF can take minutes and shouldn't
+        # hold a worker slot (or the client) open
+        document_id = await create_pending_document(
             title=title,
             user_id=user_id,
             document_type=document_type,
             specialty=specialty
         )
-        
-        # Fetch document details
-        supabase = get_supabase_client()
-        doc_response = supabase.table('documents').select(
-            'id, title, document_type, specialty, uploaded_at'
-        ).eq('id', document_id).execute()
-        
-        doc = doc_response.data[0]
-        
-        # Count chunks
-        chunk_response = supabase.table('document_chunks').select(
-            'id', count='exact'
-        ).eq('document_id', document_id).execute()
-        
-        return DocumentResponse(
-            id=doc['id'],
-            title=doc['title'],
-            document_type=doc['document_type'],
-            specialty=doc['specialty'],
-            uploaded_at=doc['uploaded_at'],
-            chunk_count=chunk_response.count,
-            user_mastery_level=1
-        )
+
+        spool.seek(0)
+        background_tasks.add_task(ingest_document, document_id, spool)
+
+        return {
+            "document_id": document_id,
+            "status": "pending",
+            "status_url": f"/api/documents/{document_id}/status"
+        }
         
     except HTTPException:
         raise
@@ -87,3 +81,37 @@ async def list_documents(user_id: str = Depends(get_current_user)):
     except Exception as e:
         logger.error(f"Failed to list documents: {e}")
         raise HTTPException(status_code=500, detail="Failed to fetch documents")
+
+
+@router.get("/{document_id}/status")
+async def get_document_status(
+    document_id: int,
+    user_id: str = Depends(get_current_user)
+):
+    """Poll ingestion status for an uploaded document"""
+    try:
+        supabase = get_supabase_client()
+        response = supabase.table('documents').select(
+            'id, title, status'
+        ).eq('id', document_id).execute()
+
+        if not response.data:
+            raise HTTPException(status_code=404, detail="Document not found")
+
+        doc = response.data[0]
+
+        chunk_response = supabase.table('document_chunks').select(
+            'id', count='exact'
+        ).eq('document_id', document_id).execute()
+
+        return {
+            "document_id": doc['id'],
+            "title": doc['title'],
+            "status": doc['status'],
+            "chunk_count": chunk_response.count
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Failed to fetch document status: {e}")
+        raise HTTPException(status_code=500, detail="Failed to fetch document status")
@@ -2,53 +2,69 @@
 Grading Router - Grading statistics and rubric
 """
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Response
+import orjson
 import logging
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
+# The rubric never changes at runtime: serialize once at import and let
+# proxies cache it, instead of re-encoding the same dict on every call.
+_RUBRIC_BYTES = orjson.dumps({
+    "total_points": 10,
+    "categories": [
+        {
+            "name": "Clinical Accuracy",
+            "max_points": 4,
+            "weight": 0.40
+        },
+        {
+            "name": "Risk Assessment",
+            "max_points": 3,
+            "weight": 0.30
+        },
+        {
+            "name": "Communication",
+            "max_points": 2,
+            "weight": 0.20
+        },
+        {
+            "name": "Efficiency",
+            "max_points": 1,
+            "weight": 0.10
+        }
+    ]
+})
+
+_STATISTICS_BYTES = orjson.dumps({
+    "total_answers": 0,
+    "average_scores": {
+        "total": 0.0,
+        "clinical_accuracy": 0.0,
+        "risk_assessment": 0.0,
+        "communication": 0.0,
+        "efficiency": 0.0
+    }
+})
+
+
 @router.get("/rubric")
 async def get_rubric():
     """Return the grading rubric"""
-    return {
-        "total_points": 10,
-        "categories": [
-            {
-                "name": "Clinical Accuracy",
-                "max_points": 4,
-                "weight": 0.40
-            },
-            {
-                "name": "Risk Assessment",
-                "max_points": 3,
-                "weight": 0.30
-            },
-            {
-                "name": "Communication",
-                "max_points": 2,
-                "weight": 0.20
-            },
-            {
-                "name": "Efficiency",
-                "max_points": 1,
-                "weight": 0.10
-            }
-        ]
-    }
+    return Response(
+        content=_RUBRIC_BYTES,
+        media_type="application/json",
+        headers={"Cache-Control": "public, max-age=86400"}
+    )
 
 
 @router.get("/statistics")
 async def get_statistics():
     """Get aggregate grading statistics"""
-    return {
-        "total_answers": 0,
-        "average_scores": {
-            "total": 0.0,
-            "clinical_accuracy": 0.0,
-            "risk_assessment": 0.0,
-            "communication": 0.0,
-            "efficiency": 0.0
-        }
-    }
+    return Response(
+        content=_STATISTICS_BYTES,
+        media_type="application/json",
+        headers={"Cache-Control": "public, max-age=60"}
+    )
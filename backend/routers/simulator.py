@@ -9,7 +9,7 @@ import logging
 from models.schemas import QuestionGenerateRequest, QuestionResponse, AnswerSubmitRequest, GradingResponse
 from services.adaptive import generate_question, get_user_current_level
 from services.grader import grade_answer
-from services.database import get_supabase_client
+from services.database import get_pg_pool
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -80,6 +80,16 @@ async def submit_answer(
         raise HTTPException(status_code=500, detail="Failed to grade answer")
 
 
+# Single-row PK lookup — asyncpg prepares and caches this statement, so
+# each call is one indexed fetch over the binary protocol instead of a
+# PostgREST HTTP round-trip.
+_PROGRESS_SQL = """
+    SELECT current_level, questions_answered, questions_correct, avg_score, last_active
+    FROM user_document_mastery
+    WHERE user_id = $1 AND document_id = $2
+"""
+
+
 @router.get("/progress/{document_id}")
 async def get_progress(
     document_id: int,
@@ -87,33 +97,29 @@ async def get_progress(
 ):
     """Get user's progress on a specific document"""
     try:
-        supabase = get_supabase_client()
-        
-        response = supabase.table('user_document_mastery').select('*').eq(
-            'user_id', user_id
-        ).eq('document_id', document_id).execute()
-        
-        if not response.data:
+        pool = await get_pg_pool()
+        row = await pool.fetchrow(_PROGRESS_SQL, user_id, document_id)
+
+        if row is None:
             return {
                 "document_id": document_id,
                 "current_level": 1,
                 "questions_answered": 0,
                 "avg_score": 0.0
             }
-        
-        mastery = response.data[0]
-        progress_pct = min(100, (mastery['avg_score'] / 8.0) * 100)
-        
+
+        progress_pct = min(100, (row['avg_score'] / 8.0) * 100)
+
         return {
             "document_id": document_id,
-            "current_level": mastery['current_level'],
-            "questions_answered": mastery['questions_answered'],
-            "questions_correct": mastery['questions_correct'],
-            "avg_score": round(mastery['avg_score'], 2),
+            "current_level": row['current_level'],
+            "questions_answered": row['questions_answered'],
+            "questions_correct": row['questions_correct'],
+            "avg_score": round(row['avg_score'], 2),
             "progress_to_next_level": round(progress_pct, 1),
-            "last_active": mastery['last_active']
+            "last_active": row['last_active']
         }
-        
+
     except Exception as e:
         logger.error(f"Error fetching progress: {e}")
         raise HTTPException(status_code=500, detail="Failed to fetch progress")
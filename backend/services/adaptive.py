@@ -4,23 +4,22 @@ Adaptive Question Generation Service (Engine A)
 Implements the 5-level difficulty system with targeted chunk retrieval.
 """
 
+import asyncio
+import functools
+import hashlib
 import logging
 from typing import List, Dict, Optional
-import random
-from openai import AsyncOpenAI
+import diskcache
+import tiktoken
+from tenacity import retry, stop_after_attempt, wait_exponential
 
 from utils.config import settings
+from utils.openai_client import get_openai_client
 from utils.embedding import create_embedding
-from services.database import get_supabase_client
+from services.database import get_supabase_client, get_pg_pool
 
 logger = logging.getLogger(__name__)
 
-# Initialize OpenAI client
-client = AsyncOpenAI(
-    api_key=settings.OPENAI_API_KEY,
-    organization=settings.OPENAI_ORG_ID
-)
-
 
 # Level-specific prompt templates
 LEVEL_PROMPTS = {
@@ -137,49 +136,242 @@ REQUIREMENTS:
 }
 
 
+# Each template is split around {context} once at import so request-time
+# assembly is plain concatenation rather than str.format parsing, and the
+# fixed prefix/suffix token counts are computed once — only the context
+# needs BPE-encoding per request.
+_LEVEL_SPLIT = {
+    level: tuple(template.split("{context}"))
+    for level, template in LEVEL_PROMPTS.items()
+}
+
+
+@functools.cache
+def _get_encoder():
+    try:
+        return tiktoken.encoding_for_model(settings.OPENAI_MODEL)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@functools.cache
+def _template_token_count(level: int) -> int:
+    encoder = _get_encoder()
+    prefix, suffix = _LEVEL_SPLIT[level]
+    return len(encoder.encode(prefix)) + len(encoder.encode(suffix))
+
+
+async def _count_prompt_tokens(level: int, context: str) -> int:
+    """Token count for a level prompt (BPE work runs off the event loop)"""
+    context_tokens = await asyncio.to_thread(_get_encoder().encode, context)
+    return _template_token_count(level) + len(context_tokens)
+
+
+# Two-tier completion cache: a small in-process dict in front of a
+# persistent diskcache. Identical (level, chunk set, topic) tuples recur
+# in practice, and a hit skips the 1-3s OpenAI round-trip and its token
+# cost entirely.
+_QUESTION_CACHE_TTL = 86400 * 7
+_QUESTION_MEMORY_MAX = 256
+
+_question_memory: Dict[str, str] = {}
+
+
+@functools.cache
+def _get_question_cache() -> diskcache.Cache:
+    return diskcache.Cache(settings.CACHE_DIR, size_limit=2 << 30)
+
+
+def _question_cache_key(level: int, chunk_ids: List[int], topic: Optional[str]) -> str:
+    raw = f"{level}|{','.join(str(c) for c in sorted(chunk_ids))}|{topic or ''}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _question_memory_put(key: str, question_text: str):
+    if len(_question_memory) >= _QUESTION_MEMORY_MAX:
+        _question_memory.pop(next(iter(_question_memory)))
+    _question_memory[key] = question_text
+
+
+def _question_cache_get(key: str) -> Optional[str]:
+    cached = _question_memory.get(key)
+    if cached is None:
+        cached = _get_question_cache().get(key)
+        if cached is not None:
+            _question_memory_put(key, cached)
+    return cached
+
+
+def _question_cache_set(key: str, question_text: str):
+    _question_memory_put(key, question_text)
+    _get_question_cache().set(key, question_text, expire=_QUESTION_CACHE_TTL)
+
+
+@retry(
+    wait=wait_exponential(multiplier=1, min=2, max=10),
+    stop=stop_after_attempt(3),
+    reraise=True
+)
+async def _create_question_completion(prompt: str) -> str:
+    client = get_openai_client()
+    response = await client.chat.completions.create(
+        model=settings.OPENAI_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0.7
+    )
+    return response.choices[0].message.content
+
+
+# Chunk-type targeting per level: novice/beginner drill standard protocol,
+# proficient mixes in special populations, advanced/expert get exceptions
+# and contraindications. Module-level tuples so the hot path allocates
+# nothing and identical array values reuse asyncpg's statement cache.
+_CHUNK_TYPE_BY_LEVEL = {
+    1: ("standard",),
+    2: ("standard",),
+    3: ("standard", "special_population"),
+    4: ("exception", "contraindication"),
+    5: ("exception", "contraindication")
+}
+
+
+# Sampling happens in SQL so we only pull TOP_K rows over the wire
+# instead of 3x that plus a Python-side random.sample
+_CHUNKS_SQL = """
+    SELECT id, content, page_number, section_header, chunk_type
+    FROM document_chunks
+    WHERE document_id = $1 AND chunk_type = ANY($2::text[])
+    ORDER BY random()
+    LIMIT $3
+"""
+
+_CHUNKS_FALLBACK_SQL = """
+    SELECT id, content, page_number, section_header, chunk_type
+    FROM document_chunks
+    WHERE document_id = $1
+    ORDER BY random()
+    LIMIT $2
+"""
+
+
 async def retrieve_chunks_for_level(
     document_id: int,
     level: int,
     topic_query: Optional[str] = None
 ) -> List[Dict]:
     """Retrieve document chunks targeted to the difficulty level"""
-    
-    supabase = get_supabase_client()
-    
-    # Determine chunk type filter based on level
-    chunk_type_filter = None
-    if level >= 4:
-        # Advanced/Expert: prioritize exceptions and contraindications
-        chunk_type_filter = ["exception", "contraindication"]
-    elif level == 3:
-        # Proficient: mix of standard and special cases
-        chunk_type_filter = ["standard", "special_population"]
-    else:
-        # Novice/Beginner: only standard chunks
-        chunk_type_filter = ["standard"]
-    
-    # Query chunks
-    query = supabase.table('document_chunks').select('*').eq('document_id', document_id)
-    
-    if chunk_type_filter:
-        query = query.in_('chunk_type', chunk_type_filter)
-    
-    response = query.limit(settings.TOP_K_RETRIEVAL * 3).execute()
-    chunks = response.data
-    
-    if not chunks:
+
+    chunk_type_filter = _CHUNK_TYPE_BY_LEVEL[level]
+
+    pool = await get_pg_pool()
+
+    rows = await pool.fetch(
+        _CHUNKS_SQL, document_id, chunk_type_filter, settings.TOP_K_RETRIEVAL
+    )
+
+    if not rows:
         # Fallback: get any chunks
-        response = supabase.table('document_chunks').select('*').eq(
-            'document_id', document_id
-        ).limit(settings.TOP_K_RETRIEVAL).execute()
-        chunks = response.data
-    
-    # Select final chunks
-    final_chunks = random.sample(chunks, min(settings.TOP_K_RETRIEVAL, len(chunks)))
-    
+        rows = await pool.fetch(
+            _CHUNKS_FALLBACK_SQL, document_id, settings.TOP_K_RETRIEVAL
+        )
+
+    final_chunks = [dict(row) for row in rows]
+
     logger.info(f"Retrieved {len(final_chunks)} chunks for level {level}")
-    
+
     return final_chunks
 
 
-async def
+async def generate_question(
+    document_id: int,
+    user_id: str,
+    current_level: int,
+    topic: Optional[str] = None
+) -> Dict:
+    """Generate a level-appropriate question from document chunks"""
+
+    # Step 1: Retrieve chunks targeted to the level
+    chunks = await retrieve_chunks_for_level(document_id, current_level, topic)
+
+    if not chunks:
+        raise ValueError(f"No content found for document {document_id}")
+
+    # Step 2: Build context from chunks
+    context = "\n\n".join([
+        f"[Page {c['page_number']}] {c['content']}"
+        for c in chunks
+    ])
+
+    # Step 3: Generate question via OpenAI (unless an identical
+    # level/chunks/topic combination was generated recently)
+    prefix, suffix = _LEVEL_SPLIT[current_level]
+    prompt = prefix + context + suffix
+    prompt_tokens = await _count_prompt_tokens(current_level, context)
+
+    cache_key = _question_cache_key(
+        current_level, [c['id'] for c in chunks], topic
+    )
+    question_text = _question_cache_get(cache_key)
+
+    if question_text is None:
+        try:
+            question_text = await _create_question_completion(prompt)
+        except Exception as e:
+            logger.error(f"OpenAI question generation failed: {e}")
+            raise ValueError(f"Failed to generate question: {str(e)}")
+        _question_cache_set(cache_key, question_text)
+    else:
+        logger.info(f"Question cache hit for level {current_level}")
+
+    # Step 4: Store question record
+    supabase = get_supabase_client()
+
+    question_response = supabase.table('questions').insert({
+        'document_id': document_id,
+        'user_id': user_id,
+        'vignette': question_text,
+        'question_text': question_text,
+        'difficulty_level': current_level,
+        'source_chunk_ids': [c['id'] for c in chunks]
+    }).execute()
+
+    question_id = question_response.data[0]['id']
+
+    logger.info(f"Generated question {question_id} at level {current_level}")
+
+    return {
+        'question_id': question_id,
+        'level': current_level,
+        'content': question_text,
+        'sources': [
+            {
+                'chunk_id': c['id'],
+                'text': c['content'][:200],
+                'page': c['page_number'],
+                'section': c.get('section_header') or None,
+                'type': c['chunk_type']
+            }
+            for c in chunks
+        ],
+        'metadata': {
+            'document_id': document_id,
+            'topic': topic,
+            'model': settings.OPENAI_MODEL,
+            'prompt_tokens': prompt_tokens
+        }
+    }
+
+
+async def get_user_current_level(user_id: str, document_id: int) -> int:
+    """Get the user's current mastery level for a document (defaults to 1)"""
+
+    supabase = get_supabase_client()
+
+    response = supabase.table('user_document_mastery').select(
+        'current_level'
+    ).eq('user_id', user_id).eq('document_id', document_id).execute()
+
+    if response.data:
+        return response.data[0]['current_level']
+
+    return 1
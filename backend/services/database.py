@@ -5,7 +5,11 @@ Supabase client initialization and helper functions.
 """
 
 import logging
+import asyncpg
+import httpx
 from supabase import create_client, Client
+from supabase.client import ClientOptions
+from supabase._async.client import AsyncClient, create_client as create_async_client
 from typing import Optional
 
 from utils.config import settings
@@ -13,33 +17,129 @@ from utils.config import settings
 logger = logging.getLogger(__name__)
 
 _supabase_client: Optional[Client] = None
+_pg_pool: Optional[asyncpg.Pool] = None
 
 
 def get_supabase_client() -> Client:
-    """Get or create Supabase client instance"""
+    """Get or create the process-wide Supabase client.
+
+    One client per process: constructing it per call would re-run TLS
+    handshakes and pile up sockets against Supabase's connection limit.
+    supabase-py doesn't expose httpx pool limits directly, so tuning is
+    restricted to the per-service timeouts ClientOptions accepts; the
+    client's internal keepalive pool handles connection reuse.
+    """
     global _supabase_client
-    
+
     if _supabase_client is None:
         try:
             _supabase_client = create_client(
                 supabase_url=settings.SUPABASE_URL,
-                supabase_key=settings.SUPABASE_SERVICE_KEY
+                supabase_key=settings.SUPABASE_SERVICE_KEY,
+                options=ClientOptions(
+                    postgrest_client_timeout=10,
+                    storage_client_timeout=30
+                )
             )
             logger.info("Supabase client initialized")
         except Exception as e:
             logger.error(f"Failed to initialize Supabase client: {e}")
             raise
-    
+
     return _supabase_client
 
 
+_async_supabase_client: Optional[AsyncClient] = None
+
+
+async def get_async_supabase_client() -> AsyncClient:
+    """Get or create the async Supabase client.
+
+    The async PostgREST transport awaits its HTTP round-trips instead of
+    blocking the event loop, so request-path code (grading, ingestion)
+    should use this; the sync client remains for scripts and startup.
+    """
+    global _async_supabase_client
+
+    if _async_supabase_client is None:
+        _async_supabase_client = await create_async_client(
+            supabase_url=settings.SUPABASE_URL,
+            supabase_key=settings.SUPABASE_SERVICE_KEY
+        )
+        logger.info("Async Supabase client initialized")
+
+    return _async_supabase_client
+
+
+def reset_supabase_client():
+    """Drop the cached clients so the next call rebuilds them.
+
+    Called when a request hits a connection-level error — the singletons'
+    sockets may be stale (NAT timeout, server restart) and recreating the
+    client is the pool_recycle equivalent for PostgREST. test_connection
+    invokes this on transport errors, so a failed readiness ping forces a
+    reconnect on the next attempt.
+    """
+    global _supabase_client, _async_supabase_client
+    _supabase_client = None
+    _async_supabase_client = None
+    logger.warning("Supabase client reset; will reconnect on next use")
+
+
+async def get_pg_pool() -> asyncpg.Pool:
+    """Get or create the shared asyncpg connection pool.
+
+    Hot-path queries go straight to Postgres over this pool instead of
+    through the supabase-py PostgREST client, which pays an HTTP+TLS
+    round-trip per query and blocks the event loop. The supabase client
+    stays around for auth/storage and infrequent queries.
+    """
+    global _pg_pool
+
+    if _pg_pool is None:
+        # When pointing DSN at pgbouncer (port 6432, transaction pooling),
+        # set statement_cache_size=0 — prepared statements don't survive
+        # transaction-pooled connections.
+        #
+        # asyncpg acquires connections LIFO, so a small working set stays
+        # hot (server-side plan/catalog caches hit) while overflow sockets
+        # opened under burst idle out via max_inactive_connection_lifetime.
+        _pg_pool = await asyncpg.create_pool(
+            dsn=settings.DATABASE_URL,
+            min_size=5,
+            max_size=settings.DATABASE_POOL_SIZE + settings.DATABASE_POOL_OVERFLOW,
+            max_inactive_connection_lifetime=settings.DATABASE_POOL_RECYCLE_SECONDS,
+            command_timeout=60,
+            statement_cache_size=1024
+        )
+        logger.info("asyncpg connection pool initialized")
+
+    return _pg_pool
+
+
+async def close_pg_pool():
+    """Close the asyncpg connection pool"""
+    global _pg_pool
+
+    if _pg_pool is not None:
+        await _pg_pool.close()
+        _pg_pool = None
+        logger.info("asyncpg connection pool closed")
+
+
 async def test_connection() -> bool:
     """Test database connection"""
     try:
-        client = get_supabase_client()
-        response = client.table('documents').select('id').limit(1).execute()
+        client = await get_async_supabase_client()
+        response = await client.table('documents').select('id').limit(1).execute()
         logger.info("✓ Database connection test passed")
         return True
+    except httpx.TransportError as e:
+        # Connect failures and timeouts suggest stale sockets; rebuild the
+        # clients so the next attempt reconnects from scratch
+        logger.error(f"✗ Database connection test failed: {e}")
+        reset_supabase_client()
+        return False
     except Exception as e:
         logger.error(f"✗ Database connection test failed: {e}")
         return False
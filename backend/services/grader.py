@@ -4,22 +4,21 @@ Answer Grading Service (Engine B)
 Implements the "Persona Grader" with structured rubric evaluation.
 """
 
+import asyncio
+import hashlib
 import logging
-from typing import Dict
-import json
-from openai import AsyncOpenAI
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+from pydantic import BaseModel, ValidationError, conint
 
 from utils.config import settings
-from services.database import get_supabase_client
+from utils.openai_client import get_openai_client
+from services.database import get_async_supabase_client
 
 logger = logging.getLogger(__name__)
 
-# Initialize OpenAI client
-client = AsyncOpenAI(
-    api_key=settings.OPENAI_API_KEY,
-    organization=settings.OPENAI_ORG_ID
-)
-
 
 GRADING_SYSTEM_PROMPT = """You are a Senior Mentor Hospitalist evaluating a colleague's clinical reasoning.
 
@@ -66,6 +65,104 @@ The level_change should be:
 - 0 otherwise (adequate performance)
 """
 
+# Bump whenever GRADING_SYSTEM_PROMPT or the rubric changes, so cached
+# results from the old prompt are never reused
+GRADING_PROMPT_VERSION = "2"
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+_SCORE_KEYS = (
+    'clinical_accuracy_score',
+    'risk_assessment_score',
+    'communication_score',
+    'efficiency_score'
+)
+_SCORE_MAXES = np.array([4, 3, 2, 1], dtype=np.int8)
+
+# Settings are immutable after startup; bind the hot-path values once
+# instead of going through Pydantic attribute lookup per request
+_MODEL = settings.OPENAI_MODEL
+_LEVEL_UP_THRESHOLD = settings.LEVEL_UP_THRESHOLD
+_LEVEL_DOWN_THRESHOLD = settings.LEVEL_DOWN_THRESHOLD
+_MAX_CHUNK_CHARS = settings.MAX_CHUNK_CHARS_IN_PROMPT
+_MAX_GUIDELINE_CHARS = settings.MAX_GUIDELINE_CHARS
+
+# Assembled once; .format fills the two per-question slots without
+# re-parsing the multi-line literal on every call
+_GRADING_CONTEXT_TMPL = """CLINICAL SCENARIO:
+{question}
+
+GUIDELINE REFERENCE:
+{guidelines}
+
+Evaluate the user's answer using the 4-domain rubric. Remember: clinical correctness alone is not enough.
+
+Respond with JSON only, no additional text."""
+
+
+class GradingResult(BaseModel):
+    """Structured-output schema for a grading response.
+
+    Mirrors the JSON contract in GRADING_SYSTEM_PROMPT; the API enforces
+    it server-side, so malformed-JSON retries disappear. total_score is
+    still recomputed from the components in validate_scores.
+    """
+    clinical_accuracy_score: conint(ge=0, le=4)
+    risk_assessment_score: conint(ge=0, le=3)
+    communication_score: conint(ge=0, le=2)
+    efficiency_score: conint(ge=0, le=1)
+    total_score: conint(ge=0, le=10)
+    feedback: str
+    level_change: conint(ge=-1, le=1)
+    strengths: List[str]
+    areas_for_improvement: List[str]
+
+
+def _grading_cache_key(question_id: str, user_answer: str) -> str:
+    """Content-addressed key for a grading request.
+
+    The answer is normalized (lowercase, collapsed whitespace) so trivial
+    edits still hit; model and prompt version are part of the key so
+    upgrades invalidate naturally.
+    """
+    normalized = _WHITESPACE_RE.sub(" ", user_answer.strip().lower())
+    payload = f"{question_id}|{normalized}|{_MODEL}|{GRADING_PROMPT_VERSION}"
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+async def _get_cached_grading(supabase, cache_key: str) -> Optional[Dict]:
+    """Look up a previous grading result; failures are treated as misses.
+
+    Cached rows come straight from JSONB, not from the structured-output
+    API, so they are re-validated against GradingResult — a legacy or
+    hand-edited row that fails the schema is discarded rather than allowed
+    to raise downstream.
+    """
+    try:
+        response = await supabase.table('graded_answers_cache').select(
+            'grading_result'
+        ).eq('key', cache_key).execute()
+        if response.data:
+            return GradingResult.model_validate(
+                response.data[0]['grading_result']
+            ).model_dump()
+    except ValidationError as e:
+        logger.warning(f"Discarding cached grading result that fails schema validation: {e}")
+    except Exception as e:
+        logger.warning(f"Grading cache lookup failed: {e}")
+    return None
+
+
+async def _store_cached_grading(supabase, cache_key: str, grading_result: Dict):
+    """Store a validated grading result; best-effort only"""
+    try:
+        await supabase.table('graded_answers_cache').upsert({
+            'key': cache_key,
+            'grading_result': grading_result
+        }).execute()
+    except Exception as e:
+        logger.warning(f"Grading cache write failed: {e}")
+
 
 async def grade_answer(
     question_id: str,
@@ -76,76 +173,92 @@ async def grade_answer(
     
     logger.info(f"Grading answer for question {question_id}, user {user_id}")
     
-    supabase = get_supabase_client()
-    
-    # Retrieve question context
-    question_response = supabase.table('questions').select(
-        'question_text, source_chunk_ids, document_id, difficulty_level'
-    ).eq('id', question_id).execute()
-    
-    if not question_response.data:
+    supabase = await get_async_supabase_client()
+
+    # One RPC gathers the question, its source chunks and the user's
+    # mastery in a single round-trip instead of three sequential reads
+    context_response = await supabase.rpc('get_grading_context', {
+        'p_question_id': question_id,
+        'p_user_id': user_id
+    }).execute()
+
+    grading_context = context_response.data
+
+    if not grading_context or not grading_context.get('question'):
         raise ValueError(f"Question {question_id} not found")
+
+    question_data = grading_context['question']
+    source_chunks = grading_context['chunks']
+    mastery = grading_context.get('mastery')
+
+    # Cap the guideline context: prompt latency and cost grow with its
+    # length, and a few oversized chunks shouldn't blow the token budget.
+    # Caps are character-based and deterministic, so the block stays
+    # byte-stable per question and prompt caching keeps working.
+    guideline_parts = []
+    remaining = _MAX_GUIDELINE_CHARS
+    for c in source_chunks:
+        if remaining <= 0:
+            break
+        part = f"[Page {c['page_number']}] {c['content'][:_MAX_CHUNK_CHARS]}"
+        guideline_parts.append(part[:remaining])
+        remaining -= len(part) + 2
+
+    guideline_context = "\n\n".join(guideline_parts)
     
-    question_data = question_response.data[0]
-    
-    # Retrieve source chunks
-    chunk_ids = question_data['source_chunk_ids']
-    chunks_response = supabase.table('document_chunks').select(
-        'content, page_number'
-    ).in_('id', chunk_ids).execute()
-    
-    guideline_context = "\n\n".join([
-        f"[Page {c['page_number']}] {c['content']}"
-        for c in chunks_response.data
-    ])
+    # Message layout is chosen for OpenAI prompt caching: the rubric system
+    # prompt is byte-stable across every call, and the scenario/guideline
+    # block is stable across all answers to the same question — both land
+    # in the cacheable prefix. Only the user's answer varies per call.
+    grading_context_prompt = _GRADING_CONTEXT_TMPL.format(
+        question=question_data['question_text'],
+        guidelines=guideline_context
+    )
     
-    # Build grading prompt
-    grading_prompt = f"""CLINICAL SCENARIO:
-{question_data['question_text']}
+    # Identical resubmissions (and regression reruns) reuse the stored
+    # grading instead of paying a 1-5s LLM round-trip
+    cache_key = _grading_cache_key(question_id, user_answer) if settings.USE_GRADING_CACHE else None
+    grading_result = None
+    if cache_key:
+        grading_result = await _get_cached_grading(supabase, cache_key)
+        if grading_result is not None:
+            grading_result = validate_scores(grading_result)
 
-USER'S ANSWER:
-{user_answer}
+    cache_write = None
 
-GUIDELINE REFERENCE:
-{guideline_context}
+    if grading_result is None:
+        # Call OpenAI for grading: structured outputs guarantee the
+        # response matches GradingResult, so there is no JSON parse to fail
+        try:
+            client = get_openai_client()
+            response = await client.beta.chat.completions.parse(
+                model=_MODEL,
+                messages=[
+                    {"role": "system", "content": GRADING_SYSTEM_PROMPT},
+                    {"role": "system", "content": grading_context_prompt},
+                    {"role": "user", "content": user_answer}
+                ],
+                temperature=0.3,
+                response_format=GradingResult,
+                user=user_id
+            )
 
-Evaluate this answer using the 4-domain rubric. Remember: clinical correctness alone is not enough.
+            grading_result = response.choices[0].message.parsed.model_dump()
 
-Respond with JSON only, no additional text."""
-    
-    # Call OpenAI for grading
-    try:
-        response = await client.chat.completions.create(
-            model=settings.OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": GRADING_SYSTEM_PROMPT},
-                {"role": "user", "content": grading_prompt}
-            ],
-            temperature=0.3,
-            response_format={"type": "json_object"}
-        )
-        
-        ai_response = response.choices[0].message.content
-        grading_result = json.loads(ai_response)
-        
-    except json.JSONDecodeError as e:
-        logger.error(f"Failed to parse grading JSON: {e}")
-        raise ValueError("Grading system returned invalid format")
-    except Exception as e:
-        logger.error(f"OpenAI grading error: {e}")
-        raise ValueError(f"Failed to grade answer: {str(e)}")
-    
-    # Validate scores
-    grading_result = validate_scores(grading_result)
-    
-    # Get user's current level
-    mastery_response = supabase.table('user_document_mastery').select(
-        'current_level, questions_answered'
-    ).eq('user_id', user_id).eq('document_id', question_data['document_id']).execute()
+        except Exception as e:
+            logger.error(f"OpenAI grading error: {e}")
+            raise ValueError(f"Failed to grade answer: {str(e)}")
+
+        # Validate scores
+        grading_result = validate_scores(grading_result)
+
+        if cache_key:
+            cache_write = _store_cached_grading(supabase, cache_key, grading_result)
     
-    if mastery_response.data:
-        current_level = mastery_response.data[0]['current_level']
-        questions_answered = mastery_response.data[0]['questions_answered']
+    # User's current standing (from the same RPC payload)
+    if mastery:
+        current_level = mastery['current_level']
+        questions_answered = mastery['questions_answered']
     else:
         current_level = 1
         questions_answered = 0
@@ -160,36 +273,39 @@ Respond with JSON only, no additional text."""
     
     new_level = max(1, min(5, current_level + level_change))
     
-    # Store answer record
-    answer_record = supabase.table('answers').insert({
-        'question_id': question_id,
-        'user_id': user_id,
-        'answer_text': user_answer,
-        'total_score': grading_result['total_score'],
-        'clinical_accuracy_score': grading_result['clinical_accuracy_score'],
-        'risk_assessment_score': grading_result['risk_assessment_score'],
-        'communication_score': grading_result['communication_score'],
-        'efficiency_score': grading_result['efficiency_score'],
-        'ai_feedback': grading_result['feedback'],
-        'ai_model_used': settings.OPENAI_MODEL,
-        'level_before': current_level,
-        'level_after': new_level,
-        'level_change': level_change
+    # Persist everything — answer insert, mastery upsert, was_answered —
+    # in one transaction server-side; the upsert derives the running stats
+    # from the stored row, so no stale-read race on concurrent gradings
+    finalize_call = supabase.rpc('finalize_grading', {
+        'p_question_id': question_id,
+        'p_user_id': user_id,
+        'p_document_id': question_data['document_id'],
+        'p_answer_text': user_answer,
+        'p_total_score': grading_result['total_score'],
+        'p_clinical_accuracy': grading_result['clinical_accuracy_score'],
+        'p_risk_assessment': grading_result['risk_assessment_score'],
+        'p_communication': grading_result['communication_score'],
+        'p_efficiency': grading_result['efficiency_score'],
+        'p_feedback': grading_result['feedback'],
+        'p_model': _MODEL,
+        'p_level_before': current_level,
+        'p_level_after': new_level,
+        'p_level_change': level_change
     }).execute()
-    
-    # Update user mastery
-    update_mastery(
-        supabase, user_id, question_data['document_id'],
-        grading_result, level_change, new_level
-    )
-    
-    # Mark question as answered
-    supabase.table('questions').update({'was_answered': True}).eq('id', question_id).execute()
-    
+
+    # The finalize RPC and the cache write are independent; run them
+    # concurrently so latency is the max of the two, not the sum
+    if cache_write is not None:
+        finalize_response, _ = await asyncio.gather(finalize_call, cache_write)
+    else:
+        finalize_response = await finalize_call
+
+    answer_id = finalize_response.data
+
     logger.info(f"Graded answer: {grading_result['total_score']}/10, level {current_level} → {new_level}")
     
     return {
-        'answer_id': answer_record.data[0]['id'],
+        'answer_id': answer_id,
         'scores': {
             'clinical_accuracy': grading_result['clinical_accuracy_score'],
             'risk_assessment': grading_result['risk_assessment_score'],
@@ -208,28 +324,27 @@ Respond with JSON only, no additional text."""
         },
         'guideline_references': [
             {'content': c['content'][:200], 'page': c['page_number']}
-            for c in chunks_response.data
+            for c in source_chunks
         ]
     }
 
 
 def validate_scores(grading_result: Dict) -> Dict:
-    """Ensure scores are within valid ranges"""
-    grading_result['clinical_accuracy_score'] = max(0, min(4, grading_result.get('clinical_accuracy_score', 0)))
-    grading_result['risk_assessment_score'] = max(0, min(3, grading_result.get('risk_assessment_score', 0)))
-    grading_result['communication_score'] = max(0, min(2, grading_result.get('communication_score', 0)))
-    grading_result['efficiency_score'] = max(0, min(1, grading_result.get('efficiency_score', 0)))
-    
-    calculated_total = (
-        grading_result['clinical_accuracy_score'] +
-        grading_result['risk_assessment_score'] +
-        grading_result['communication_score'] +
-        grading_result['efficiency_score']
-    )
-    
-    grading_result['total_score'] = calculated_total
-    grading_result['level_change'] = max(-1, min(1, grading_result.get('level_change', 0)))
-    
+    """Clamp the component scores to the rubric and recompute the total.
+
+    Fresh responses and cache hits are both schema-validated before they
+    reach here, so every key is present and in range; the clamp is cheap
+    defense-in-depth, and the part the schema cannot express — total_score
+    equal to the sum of the components — is recomputed unconditionally.
+    """
+    scores = np.array([grading_result[key] for key in _SCORE_KEYS], dtype=np.int8)
+    np.clip(scores, 0, _SCORE_MAXES, out=scores)
+
+    for key, score in zip(_SCORE_KEYS, scores):
+        grading_result[key] = int(score)
+
+    grading_result['total_score'] = int(scores.sum())
+
     return grading_result
 
 
@@ -244,11 +359,11 @@ def calculate_level_change(
     consistency_requirement = {1: 1, 2: 2, 3: 3, 4: 3, 5: 5}
     required_questions = consistency_requirement.get(current_level, 3)
     
-    if current_score < settings.LEVEL_DOWN_THRESHOLD:
+    if current_score < _LEVEL_DOWN_THRESHOLD:
         return -1
     
     if raw_level_change > 0:
-        if questions_answered >= required_questions and current_score >= settings.LEVEL_UP_THRESHOLD:
+        if questions_answered >= required_questions and current_score >= _LEVEL_UP_THRESHOLD:
             return 1
         else:
             return 0
@@ -256,30 +371,6 @@ def calculate_level_change(
     return 0
 
 
-def update_mastery(supabase, user_id, document_id, grading_result, level_change, new_level):
-    """Update user mastery record"""
-    
-    # Get current stats
-    response = supabase.table('user_document_mastery').select('*').eq(
-        'user_id', user_id
-    ).eq('document_id', document_id).execute()
-    
-    if response.data:
-        current = response.data[0]
-        q_count = current['questions_answered']
-        
-        # Calculate new averages
-        new_avg = ((current['avg_score'] * q_count) + grading_result['total_score']) / (q_count + 1)
-        
-        supabase.table('user_document_mastery').update({
-            'current_level': new_level,
-            'questions_answered': q_count + 1,
-            'questions_correct': current['questions_correct'] + (1 if grading_result['total_score'] >= 7 else 0),
-            'avg_score': new_avg,
-            'last_active': 'now()'
-        }).eq('user_id', user_id).eq('document_id', document_id).execute()
-
-
 def get_level_change_message(level_change: int, score: float) -> str:
     """Generate user-friendly message"""
     if level_change > 0:
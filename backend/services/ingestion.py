@@ -4,97 +4,136 @@ PDF Ingestion Service
 Handles PDF → Text → Chunks → Embeddings → Database pipeline.
 """
 
+import asyncio
+import bisect
+import io
 import logging
-from typing import List, Dict, Tuple
+from dataclasses import dataclass
+from typing import List, Tuple
 import re
-from pypdf import PdfReader
+import ahocorasick
+import pypdfium2 as pdfium
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from io import BytesIO
 
 from utils.config import settings
 from utils.embedding import create_embeddings_batch
-from services.database import get_supabase_client
+from services.database import get_async_supabase_client
 
 logger = logging.getLogger(__name__)
 
 
+@dataclass(slots=True)
 class DocumentChunk:
-    """Represents a single chunk with metadata"""
-    def __init__(
-        self,
-        content: str,
-        page_number: int,
-        section_header: str = "",
-        chunk_type: str = "standard"
-    ):
-        self.content = content
-        self.page_number = page_number
-        self.section_header = section_header
-        self.chunk_type = chunk_type
-
-
-def extract_text_from_pdf(pdf_bytes: bytes) -> Tuple[str, Dict[int, str]]:
-    """Extract text from PDF file"""
+    """Represents a single chunk with metadata.
+
+    slots=True: a large guideline yields thousands of these held alive
+    until the insert completes, so skipping the per-instance __dict__
+    saves real memory during ingestion.
+    """
+    content: str
+    page_number: int
+    section_header: str = ""
+    chunk_type: str = "standard"
+
+
+def extract_text_from_pdf(pdf_file) -> Tuple[str, List[Tuple[int, int]]]:
+    """Extract text from a PDF file object.
+
+    Returns the combined text plus a list of (char_offset, page_number)
+    pairs marking where each page starts in it, so chunks can be mapped
+    back to pages with a binary search instead of substring scans.
+    """
     try:
-        pdf_file = BytesIO(pdf_bytes)
-        reader = PdfReader(pdf_file)
-        
-        full_text = []
-        page_dict = {}
-        
-        for page_num, page in enumerate(reader.pages, start=1):
-            try:
-                text = page.extract_text()
-                if text.strip():
-                    full_text.append(text)
-                    page_dict[page_num] = text
-                else:
-                    logger.warning(f"Page {page_num} has no extractable text")
-            except Exception as e:
-                logger.error(f"Failed to extract text from page {page_num}: {e}")
-        
-        combined_text = "\n\n".join(full_text)
-        logger.info(f"Extracted {len(combined_text)} characters from {len(page_dict)} pages")
-        
-        return combined_text, page_dict
-        
+        # PDFium does the parsing in C; pages are read sequentially because
+        # a PDFium document must not be touched from multiple threads
+        pdf = pdfium.PdfDocument(pdf_file)
+
+        # Single growing buffer instead of a list of page strings plus a
+        # joined copy — one resident copy of the document, not two
+        buffer = io.StringIO()
+        page_offsets = []
+
+        try:
+            for page_index in range(len(pdf)):
+                page_num = page_index + 1
+                try:
+                    textpage = pdf[page_index].get_textpage()
+                    text = textpage.get_text_range()
+                    if text.strip():
+                        page_offsets.append((buffer.tell(), page_num))
+                        buffer.write(text)
+                        buffer.write("\n\n")
+                    else:
+                        logger.warning(f"Page {page_num} has no extractable text")
+                except Exception as e:
+                    logger.error(f"Failed to extract text from page {page_num}: {e}")
+        finally:
+            pdf.close()
+
+        combined_text = buffer.getvalue()
+        logger.info(f"Extracted {len(combined_text)} characters from {len(page_offsets)} pages")
+
+        return combined_text, page_offsets
+
     except Exception as e:
         logger.error(f"PDF extraction failed: {e}")
         raise ValueError(f"Failed to extract text from PDF: {str(e)}")
 
 
-def identify_chunk_type(content: str) -> str:
-    """Classify chunk type based on content patterns"""
-    content_lower = content.lower()
-    
-    # Contraindication patterns
-    contraindication_keywords = [
+# Keyword → chunk type, in descending priority: a chunk mentioning both a
+# contraindication and an exception is classified as the former, matching
+# the order of the original per-category scans
+_CHUNK_TYPE_KEYWORDS = {
+    "contraindication": [
         "contraindicated", "do not use", "should not", "must not",
         "avoid", "contraindication", "prohibited"
-    ]
-    if any(keyword in content_lower for keyword in contraindication_keywords):
-        return "contraindication"
-    
-    # Exception patterns
-    exception_keywords = [
+    ],
+    "exception": [
         "however", "exception", "in contrast", "alternatively", "but",
         "special case", "unique scenario"
-    ]
-    if any(keyword in content_lower for keyword in exception_keywords):
-        return "exception"
-    
-    # Special population patterns
-    special_pop_keywords = [
+    ],
+    "special_population": [
         "pregnancy", "pediatric", "geriatric", "renal impairment",
         "hepatic impairment", "dialysis", "elderly", "children"
     ]
-    if any(keyword in content_lower for keyword in special_pop_keywords):
-        return "special_population"
-    
-    return "standard"
+}
+
+_CHUNK_TYPE_PRIORITY = {"contraindication": 0, "exception": 1, "special_population": 2}
+
 
+def _build_keyword_automaton() -> ahocorasick.Automaton:
+    automaton = ahocorasick.Automaton()
+    for chunk_type, keywords in _CHUNK_TYPE_KEYWORDS.items():
+        for keyword in keywords:
+            automaton.add_word(keyword, chunk_type)
+    automaton.make_automaton()
+    return automaton
 
-def create_smart_chunks(text: str, page_dict: Dict[int, str]) -> List[DocumentChunk]:
+
+_KEYWORD_AUTOMATON = _build_keyword_automaton()
+
+
+def identify_chunk_type(content_lower: str) -> str:
+    """Classify chunk type based on content patterns.
+
+    Takes already-lowercased text — the splitter loop normalizes each
+    chunk exactly once — and finds every keyword in a single Aho-Corasick
+    pass instead of up to 22 separate substring scans.
+    """
+    best = None
+    for _, chunk_type in _KEYWORD_AUTOMATON.iter(content_lower):
+        rank = _CHUNK_TYPE_PRIORITY[chunk_type]
+        if best is None or rank < best:
+            best = rank
+            if best == 0:
+                break
+
+    if best is None:
+        return "standard"
+    return next(t for t, r in _CHUNK_TYPE_PRIORITY.items() if r == best)
+
+
+def create_smart_chunks(text: str, page_offsets: List[Tuple[int, int]]) -> List[DocumentChunk]:
     """Create semantically-aware chunks using RecursiveCharacterTextSplitter"""
     
     splitter = RecursiveCharacterTextSplitter(
@@ -108,20 +147,32 @@ def create_smart_chunks(text: str, page_dict: Dict[int, str]) -> List[DocumentCh
     logger.info(f"Created {len(raw_chunks)} raw chunks")
     
     smart_chunks = []
-    
+
+    # The splitter emits chunks in document order, so each one can be
+    # located with a single forward find and its page recovered by
+    # bisecting the page-start offsets — no per-page substring rescans
+    page_starts = [start for start, _ in page_offsets]
+    last_pos = 0
+
     for chunk_text in raw_chunks:
-        # Find which page this chunk belongs to
+        pos = text.find(chunk_text, last_pos)
+        if pos == -1:
+            pos = text.find(chunk_text)
+
         page_number = 1
-        for page_num, page_text in page_dict.items():
-            if chunk_text[:100] in page_text:
-                page_number = page_num
-                break
-        
-        # Classify chunk type
-        chunk_type = identify_chunk_type(chunk_text)
-        
+        if pos != -1:
+            index = bisect.bisect_right(page_starts, pos) - 1
+            if index >= 0:
+                page_number = page_offsets[index][1]
+            # chunks overlap, so advance only past this chunk's start
+            last_pos = pos + 1
+
+        # Normalize once: stripped form is stored, lowered form classified
+        stripped = chunk_text.strip()
+        chunk_type = identify_chunk_type(stripped.lower())
+
         chunk = DocumentChunk(
-            content=chunk_text.strip(),
+            content=stripped,
             page_number=page_number,
             section_header="",
             chunk_type=chunk_type
@@ -134,87 +185,137 @@ def create_smart_chunks(text: str, page_dict: Dict[int, str]) -> List[DocumentCh
     return smart_chunks
 
 
-async def ingest_document(
-    pdf_bytes: bytes,
+async def create_pending_document(
     title: str,
     user_id: str,
     document_type: str = "guideline",
     specialty: str = "hospitalist"
 ) -> int:
-    """Complete ingestion pipeline: PDF → Database with embeddings"""
-    
-    logger.info(f"Starting ingestion for: {title}")
-    
-    # Step 1: Extract text
-    full_text, page_dict = extract_text_from_pdf(pdf_bytes)
-    
-    if not full_text.strip():
-        raise ValueError("No text could be extracted from PDF")
-    
-    # Step 2: Create chunks
-    chunks = create_smart_chunks(full_text, page_dict)
-    
-    if not chunks:
-        raise ValueError("Failed to create chunks from document")
-    
-    # Step 3: Generate embeddings
-    chunk_texts = [chunk.content for chunk in chunks]
-    embeddings = await create_embeddings_batch(chunk_texts)
-    
-    # Step 4: Store in database
-    supabase = get_supabase_client()
-    
-    # Insert document
-    doc_response = supabase.table("documents").insert({
+    """Create the documents row up front so the upload can return immediately"""
+
+    supabase = await get_async_supabase_client()
+
+    doc_response = await supabase.table("documents").insert({
         "title": title,
-        "content": full_text,
+        "content": "",
         "uploaded_by": user_id,
         "document_type": document_type,
         "specialty": specialty,
-        "is_active": True
+        "is_active": True,
+        "status": "pending"
     }).execute()
-    
+
     document_id = doc_response.data[0]["id"]
     logger.info(f"Created document {document_id}: {title}")
-    
-    # Insert chunks
-    chunk_records = []
-    for chunk, embedding in zip(chunks, embeddings):
-        chunk_records.append({
-            "document_id": document_id,
-            "content": chunk.content,
-            "embedding": embedding,
-            "page_number": chunk.page_number,
-            "section_header": chunk.section_header,
-            "chunk_type": chunk.chunk_type
-        })
-    
-    # Batch insert
-    batch_size = 500
-    for i in range(0, len(chunk_records), batch_size):
-        batch = chunk_records[i:i + batch_size]
-        supabase.table("document_chunks").insert(batch).execute()
-        logger.info(f"Inserted chunk batch {i // batch_size + 1}")
-    
-    logger.info(f"✓ Ingestion complete: {len(chunks)} chunks stored for document {document_id}")
-    
+
     return document_id
 
 
-def validate_pdf(pdf_bytes: bytes) -> Tuple[bool, str]:
-    """Validate PDF before processing"""
-    size_mb = len(pdf_bytes) / (1024 * 1024)
+async def ingest_document(document_id: int, pdf_file) -> None:
+    """Ingestion pipeline for a pending document: PDF → chunks → embeddings.
+
+    Runs as a background task after upload; progress is tracked via the
+    documents.status column so clients can poll instead of holding the
+    upload request open for the whole pipeline.
+    """
+
+    supabase = await get_async_supabase_client()
+
+    try:
+        await supabase.table("documents").update(
+            {"status": "processing"}
+        ).eq("id", document_id).execute()
+
+        # Step 1: Extract text. CPU-bound parsing runs on a worker thread
+        # so the serving event loop stays responsive; the PDFium handle is
+        # created and closed inside the single threaded call, satisfying
+        # its one-thread-at-a-time constraint.
+        full_text, page_offsets = await asyncio.to_thread(
+            extract_text_from_pdf, pdf_file
+        )
+
+        if not full_text.strip():
+            raise ValueError("No text could be extracted from PDF")
+
+        # Step 2: Create chunks (splitting and classification are pure CPU)
+        chunks = await asyncio.to_thread(create_smart_chunks, full_text, page_offsets)
+
+        if not chunks:
+            raise ValueError("Failed to create chunks from document")
+
+        # Step 3: Generate embeddings
+        chunk_texts = [chunk.content for chunk in chunks]
+        embeddings = await create_embeddings_batch(chunk_texts)
+
+        # Step 4: Store chunks
+        chunk_records = []
+        for chunk, embedding in zip(chunks, embeddings):
+            chunk_records.append({
+                "document_id": document_id,
+                "content": chunk.content,
+                "embedding": embedding,
+                "page_number": chunk.page_number,
+                "section_header": chunk.section_header,
+                "chunk_type": chunk.chunk_type
+            })
+
+        # Batch insert: batches are independent, so fire them concurrently
+        # with a semaphore keeping at most 4 in flight against Supabase
+        batch_size = 500
+        semaphore = asyncio.Semaphore(4)
+
+        async def insert_batch(batch):
+            async with semaphore:
+                await supabase.table("document_chunks").insert(batch).execute()
+
+        await asyncio.gather(*[
+            insert_batch(chunk_records[i:i + batch_size])
+            for i in range(0, len(chunk_records), batch_size)
+        ])
+        logger.info(f"Inserted {len(chunk_records)} chunks in {(len(chunk_records) + batch_size - 1) // batch_size} batches")
+
+        await supabase.table("documents").update({
+            "content": full_text,
+            "status": "ready"
+        }).eq("id", document_id).execute()
+
+        logger.info(f"✓ Ingestion complete: {len(chunks)} chunks stored for document {document_id}")
+
+    except Exception as e:
+        logger.error(f"Ingestion failed for document {document_id}: {e}", exc_info=True)
+        await supabase.table("documents").update(
+            {"status": "failed"}
+        ).eq("id", document_id).execute()
+    finally:
+        pdf_file.close()
+
+
+def validate_pdf(pdf_file) -> Tuple[bool, str]:
+    """Validate a PDF file object before processing.
+
+    Deliberately cheap: size, leading %PDF magic, and the %%EOF marker in
+    the trailer. A full parse here would duplicate the one ingestion does
+    anyway — on a 50 MB file that's seconds of work just to reject garbage
+    the trailer check already catches. Truly corrupt files surface during
+    extraction and mark the document failed.
+    """
+    size = pdf_file.seek(0, 2)
+    size_mb = size / (1024 * 1024)
     if size_mb > settings.MAX_UPLOAD_SIZE_MB:
+        pdf_file.seek(0)
         return False, f"PDF too large: {size_mb:.1f}MB (max: {settings.MAX_UPLOAD_SIZE_MB}MB)"
-    
-    if not pdf_bytes.startswith(b'%PDF'):
+
+    pdf_file.seek(0)
+    header = pdf_file.read(5)
+    if not header.startswith(b'%PDF'):
+        pdf_file.seek(0)
         return False, "File is not a valid PDF"
-    
-    try:
-        reader = PdfReader(BytesIO(pdf_bytes))
-        if len(reader.pages) == 0:
-            return False, "PDF has no pages"
-    except Exception as e:
-        return False, f"Corrupted PDF: {str(e)}"
-    
+
+    # A well-formed PDF ends with %%EOF (possibly followed by whitespace)
+    pdf_file.seek(max(0, size - 1024))
+    trailer = pdf_file.read()
+    pdf_file.seek(0)
+    if b'%%EOF' not in trailer:
+        return False, "Corrupted PDF: missing end-of-file marker"
+
     return True, ""
@@ -4,6 +4,8 @@ Configuration Management
 Centralized settings using Pydantic for validation and environment variables.
 """
 
+from functools import lru_cache
+
 from pydantic_settings import BaseSettings
 from pydantic import Field, validator
 from typing import List
@@ -18,18 +20,24 @@ class Settings(BaseSettings):
     APP_VERSION: str = "1.0.0"
     DEBUG: bool = Field(default=False, description="Enable debug mode")
     LOG_LEVEL: str = Field(default="INFO", description="Logging level")
+    WORKERS: int = Field(default=1, description="Uvicorn worker processes")
+    ENABLE_TIMING: bool = Field(default=True, description="Add X-Process-Time headers")
     
     # ========== OpenAI ==========
     OPENAI_API_KEY: str = Field(..., description="OpenAI API key")
     OPENAI_ORG_ID: str = Field(default="org-vqF6oLvoV4GIIq4fmxwoqpHz", description="OpenAI organization ID")
     OPENAI_MODEL: str = Field(default="gpt-4o", description="Model for question generation")
     OPENAI_EMBEDDING_MODEL: str = Field(default="text-embedding-3-small", description="Embedding model")
+    EMBEDDING_CONCURRENCY: int = Field(default=4, description="Concurrent embedding batch requests")
     
     # ========== Database ==========
     SUPABASE_URL: str = Field(..., description="Supabase project URL")
     SUPABASE_SERVICE_KEY: str = Field(..., description="Supabase service role key")
     SUPABASE_ANON_KEY: str = Field(..., description="Supabase anon key")
     DATABASE_URL: str = Field(..., description="PostgreSQL connection string")
+    DATABASE_POOL_SIZE: int = Field(default=20, description="asyncpg pool target size")
+    DATABASE_POOL_OVERFLOW: int = Field(default=10, description="Extra pool connections under burst")
+    DATABASE_POOL_RECYCLE_SECONDS: float = Field(default=1800.0, description="Recycle idle pool connections after this long")
     
     # ========== CORS ==========
     ALLOWED_ORIGINS: List[str] = Field(
@@ -43,11 +51,17 @@ class Settings(BaseSettings):
             return [origin.strip() for origin in v.split(",")]
         return v
     
+    # ========== Caching ==========
+    CACHE_DIR: str = Field(default=".cache", description="Directory for the on-disk response cache")
+    USE_GRADING_CACHE: bool = Field(default=True, description="Reuse grading results for identical answers")
+
     # ========== RAG Configuration ==========
     CHUNK_SIZE: int = Field(default=800, description="Characters per chunk")
     CHUNK_OVERLAP: int = Field(default=100, description="Overlap between chunks")
     TOP_K_RETRIEVAL: int = Field(default=3, description="Number of chunks to retrieve")
     MIN_SIMILARITY_THRESHOLD: float = Field(default=0.70, description="Minimum cosine similarity")
+    MAX_CHUNK_CHARS_IN_PROMPT: int = Field(default=800, description="Per-chunk character cap in LLM prompts")
+    MAX_GUIDELINE_CHARS: int = Field(default=4000, description="Total guideline context cap in LLM prompts")
     
     # ========== Adaptive Logic ==========
     LEVEL_UP_THRESHOLD: float = Field(default=8.0, description="Score needed to level up")
@@ -93,7 +107,20 @@ class Settings(BaseSettings):
         }
 
 
-settings = Settings()
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Construct Settings once per process.
+
+    The cache means pre-forked workers and tests share a single
+    environment read, and tests can call get_settings.cache_clear() after
+    patching the environment instead of monkeypatching module globals.
+    """
+    return Settings()
+
+
+# Module-level alias: every existing `from utils.config import settings`
+# keeps working and resolves to the cached instance
+settings = get_settings()
 
 
 def validate_configuration():
@@ -117,6 +144,3 @@ def validate_configuration():
     
     if errors:
         raise ValueError(f"Configuration errors:\n" + "\n".join(f"  - {e}" for e in errors))
-
-
-validate_configuration()
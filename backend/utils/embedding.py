@@ -7,19 +7,84 @@ Wrapper for OpenAI embedding API with error handling.
 import asyncio
 from typing import List
 import numpy as np
-from openai import AsyncOpenAI
-from tenacity import retry, stop_after_attempt, wait_exponential
+from openai import RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential, wait_exponential_jitter
 import logging
 
 from utils.config import settings
+from utils.openai_client import get_openai_client
 
 logger = logging.getLogger(__name__)
 
-# Initialize OpenAI client
-client = AsyncOpenAI(
-    api_key=settings.OPENAI_API_KEY,
-    organization=settings.OPENAI_ORG_ID
-)
+
+# Micro-batching: single-text requests that arrive within a few ms are
+# coalesced into one OpenAI call by a background consumer, amortizing the
+# HTTP round-trip across concurrent callers. The worker is started from
+# the app lifespan; without it create_embedding falls back to direct calls
+# (scripts, tests).
+_BATCH_WINDOW_SECONDS = 0.008
+_BATCH_MAX_SIZE = 128
+
+_embed_queue = None
+_embed_worker = None
+
+
+async def _embedding_worker():
+    client = get_openai_client()
+    loop = asyncio.get_running_loop()
+
+    while True:
+        items = [await _embed_queue.get()]
+        deadline = loop.time() + _BATCH_WINDOW_SECONDS
+
+        while len(items) < _BATCH_MAX_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(_embed_queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+
+        try:
+            response = await client.embeddings.create(
+                model=settings.OPENAI_EMBEDDING_MODEL,
+                input=[text for text, _ in items]
+            )
+        except Exception as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+
+        for (_, future), data in zip(items, response.data):
+            if not future.done():
+                future.set_result(data.embedding)
+
+
+async def start_embedding_worker():
+    """Start the embedding batch consumer (called from app lifespan)"""
+    global _embed_queue, _embed_worker
+
+    if _embed_worker is None:
+        _embed_queue = asyncio.Queue()
+        _embed_worker = asyncio.create_task(_embedding_worker())
+        logger.info("Embedding batch worker started")
+
+
+async def stop_embedding_worker():
+    """Stop the embedding batch consumer"""
+    global _embed_queue, _embed_worker
+
+    if _embed_worker is not None:
+        _embed_worker.cancel()
+        try:
+            await _embed_worker
+        except asyncio.CancelledError:
+            pass
+        _embed_worker = None
+        _embed_queue = None
+        logger.info("Embedding batch worker stopped")
 
 
 @retry(
@@ -31,66 +96,116 @@ async def create_embedding(text: str) -> List[float]:
     """Create an embedding for a single text string"""
     try:
         text = text.strip().replace("\n", " ")
-        
+
         if not text:
             raise ValueError("Cannot create embedding for empty text")
-        
-        response = await client.embeddings.create(
-            model=settings.OPENAI_EMBEDDING_MODEL,
-            input=text
-        )
-        
-        embedding = response.data[0].embedding
+
+        if _embed_queue is not None:
+            future = asyncio.get_running_loop().create_future()
+            await _embed_queue.put((text, future))
+            embedding = await future
+        else:
+            response = await get_openai_client().embeddings.create(
+                model=settings.OPENAI_EMBEDDING_MODEL,
+                input=text
+            )
+            embedding = response.data[0].embedding
+
         logger.debug(f"Created embedding for text (length={len(text)})")
-        
+
         return embedding
-        
+
     except Exception as e:
         logger.error(f"Failed to create embedding: {e}")
         raise
 
 
-async def create_embeddings_batch(texts: List[str], batch_size: int = 100) -> List[List[float]]:
-    """Create embeddings for multiple texts in batches"""
+@retry(
+    retry=retry_if_exception_type(RateLimitError),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+async def _embed_one_batch(batch: List[str], semaphore: asyncio.Semaphore) -> List[List[float]]:
+    """Embed one batch of texts; retries with jittered backoff on 429s"""
+    async with semaphore:
+        response = await get_openai_client().embeddings.create(
+            model=settings.OPENAI_EMBEDDING_MODEL,
+            input=batch
+        )
+
+    # Normalize then drop to float16: halves storage and insert
+    # payload with negligible quality loss for text-embedding-3-*,
+    # matching the halfvec column the chunks are stored in
+    batch_matrix = normalize_embeddings(
+        np.asarray([data.embedding for data in response.data], dtype=np.float32)
+    ).astype(np.float16)
+    return batch_matrix.tolist()
+
+
+async def create_embeddings_batch(texts: List[str], batch_size: int = 2048) -> List[List[float]]:
+    """Create embeddings for multiple texts.
+
+    The endpoint takes up to 2048 inputs per request and answers a full
+    batch in roughly the wall time of a small one, so batches are as large
+    as allowed and dispatched concurrently (EMBEDDING_CONCURRENCY in
+    flight); rate limits are handled by backoff, not a fixed sleep.
+    """
+    semaphore = asyncio.Semaphore(settings.EMBEDDING_CONCURRENCY)
+
+    try:
+        results = await asyncio.gather(*[
+            _embed_one_batch(texts[i:i + batch_size], semaphore)
+            for i in range(0, len(texts), batch_size)
+        ])
+    except Exception as e:
+        logger.error(f"Failed to create batch embeddings: {e}")
+        raise
+
     all_embeddings = []
-    
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i:i + batch_size]
-        
-        try:
-            response = await client.embeddings.create(
-                model=settings.OPENAI_EMBEDDING_MODEL,
-                input=batch
-            )
-            
-            batch_embeddings = [data.embedding for data in response.data]
-            all_embeddings.extend(batch_embeddings)
-            
-            logger.info(f"Created embeddings for batch {i // batch_size + 1}")
-            
-            if i + batch_size < len(texts):
-                await asyncio.sleep(0.5)
-                
-        except Exception as e:
-            logger.error(f"Failed to create batch embeddings: {e}")
-            raise
-    
+    for batch_embeddings in results:
+        all_embeddings.extend(batch_embeddings)
+
+    logger.info(f"Created {len(all_embeddings)} embeddings in {len(results)} batches")
     return all_embeddings
 
 
+def normalize_embeddings(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalize a (N, D) embedding matrix row-wise (zero rows stay zero)"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    np.maximum(norms, 1e-12, out=norms)
+    return matrix / norms
+
+
+def cosine_similarity_batch(query: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+    """Cosine similarity of one query against N candidates in a single matmul.
+
+    Both inputs must be pre-normalized (see normalize_embeddings): the
+    query a (D,) vector, the candidates a contiguous (N, D) float32 matrix.
+    One BLAS GEMV replaces N Python-level calls and 2N list→array
+    conversions — keep chunk embeddings stored as one ndarray, not a list
+    of lists, so retrieval stays on this path.
+    """
+    return np.clip(matrix @ query, 0.0, 1.0)
+
+
 def cosine_similarity(embedding1: List[float], embedding2: List[float]) -> float:
-    """Calculate cosine similarity between two embeddings"""
-    vec1 = np.array(embedding1)
-    vec2 = np.array(embedding2)
-    
-    dot_product = np.dot(vec1, vec2)
+    """Calculate cosine similarity between two embeddings.
+
+    Scalar convenience wrapper; scoring a query against many chunks should
+    go through cosine_similarity_batch instead.
+    """
+    vec1 = np.asarray(embedding1, dtype=np.float32)
+    vec2 = np.asarray(embedding2, dtype=np.float32)
+
     norm1 = np.linalg.norm(vec1)
     norm2 = np.linalg.norm(vec2)
-    
+
     if norm1 == 0 or norm2 == 0:
         return 0.0
-    
-    similarity = dot_product / (norm1 * norm2)
+
+    similarity = np.dot(vec1, vec2) / (norm1 * norm2)
     return float(np.clip(similarity, 0.0, 1.0))
 
 
@@ -0,0 +1,58 @@
+"""
+Shared OpenAI Client
+====================
+Single AsyncOpenAI instance over a tuned httpx connection pool.
+"""
+
+import logging
+from typing import Optional
+import httpx
+from openai import AsyncOpenAI
+
+from utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+_http_client: Optional[httpx.AsyncClient] = None
+_client: Optional[AsyncOpenAI] = None
+
+
+def get_openai_client() -> AsyncOpenAI:
+    """Get or create the shared AsyncOpenAI client.
+
+    One HTTP/2 pool for every OpenAI call in the process — completions and
+    embeddings multiplex over a few keepalive sockets instead of each module
+    paying its own TLS handshakes and default pool limits under load. Built
+    lazily so importing a service module doesn't pay for it.
+    """
+    global _http_client, _client
+
+    if _client is None:
+        _http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=200,
+                max_keepalive_connections=100,
+                keepalive_expiry=60
+            ),
+            timeout=httpx.Timeout(connect=5, read=60, write=30, pool=5)
+        )
+        _client = AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            organization=settings.OPENAI_ORG_ID,
+            http_client=_http_client
+        )
+        logger.info("OpenAI client initialized")
+
+    return _client
+
+
+async def close_openai_client():
+    """Close the shared HTTP pool (called from app lifespan shutdown)"""
+    global _http_client, _client
+
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+        _client = None
+        logger.info("OpenAI HTTP client closed")
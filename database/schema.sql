@@ -14,7 +14,8 @@ CREATE TABLE documents (
     uploaded_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     document_type TEXT CHECK (document_type IN ('guideline', 'protocol', 'textbook')),
     specialty TEXT,
-    is_active BOOLEAN DEFAULT TRUE
+    is_active BOOLEAN DEFAULT TRUE,
+    status TEXT DEFAULT 'pending' CHECK (status IN ('pending', 'processing', 'ready', 'failed'))
 );
 
 -- Document chunks with embeddings
@@ -22,7 +23,9 @@ CREATE TABLE document_chunks (
     id BIGSERIAL PRIMARY KEY,
     document_id BIGINT REFERENCES documents(id) ON DELETE CASCADE,
     content TEXT NOT NULL,
-    embedding VECTOR(1536) NOT NULL,
+    -- halfvec: embeddings arrive L2-normalized and cast to float16 by the
+    -- backend, halving storage and scan bandwidth vs vector(1536)
+    embedding HALFVEC(1536) NOT NULL,
     page_number INTEGER,
     section_header TEXT,
     chunk_type TEXT CHECK (chunk_type IN ('standard', 'exception', 'contraindication', 'special_population')),
@@ -71,15 +74,129 @@ CREATE TABLE answers (
     communication_score FLOAT CHECK (communication_score BETWEEN 0 AND 2),
     efficiency_score FLOAT CHECK (efficiency_score BETWEEN 0 AND 1),
     ai_feedback TEXT,
+    ai_model_used TEXT,
     level_before INTEGER,
     level_after INTEGER,
     level_change INTEGER CHECK (level_change BETWEEN -1 AND 1)
 );
 
+-- Content-addressed cache of OpenAI grading responses. Keyed by
+-- sha256(question_id || normalized answer || model || prompt version)
+-- so identical resubmissions skip the LLM call entirely.
+CREATE TABLE graded_answers_cache (
+    key TEXT PRIMARY KEY,
+    grading_result JSONB NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Grading support functions: one round-trip for the reads that precede
+-- grading, and one transaction for the writes that follow it
+
+CREATE OR REPLACE FUNCTION get_grading_context(p_question_id UUID, p_user_id UUID)
+RETURNS JSONB
+LANGUAGE sql STABLE
+AS $$
+    SELECT jsonb_build_object(
+        'question', (
+            SELECT jsonb_build_object(
+                'question_text', q.question_text,
+                'source_chunk_ids', q.source_chunk_ids,
+                'document_id', q.document_id,
+                'difficulty_level', q.difficulty_level
+            )
+            FROM questions q
+            WHERE q.id = p_question_id
+        ),
+        'chunks', (
+            SELECT COALESCE(jsonb_agg(jsonb_build_object(
+                'content', c.content,
+                'page_number', c.page_number
+            )), '[]'::jsonb)
+            FROM document_chunks c
+            WHERE c.id = ANY((SELECT q.source_chunk_ids FROM questions q WHERE q.id = p_question_id))
+        ),
+        'mastery', (
+            SELECT jsonb_build_object(
+                'current_level', m.current_level,
+                'questions_answered', m.questions_answered,
+                'questions_correct', m.questions_correct,
+                'avg_score', m.avg_score
+            )
+            FROM user_document_mastery m
+            WHERE m.user_id = p_user_id
+              AND m.document_id = (SELECT q.document_id FROM questions q WHERE q.id = p_question_id)
+        )
+    );
+$$;
+
+CREATE OR REPLACE FUNCTION finalize_grading(
+    p_question_id UUID,
+    p_user_id UUID,
+    p_document_id BIGINT,
+    p_answer_text TEXT,
+    p_total_score FLOAT,
+    p_clinical_accuracy FLOAT,
+    p_risk_assessment FLOAT,
+    p_communication FLOAT,
+    p_efficiency FLOAT,
+    p_feedback TEXT,
+    p_model TEXT,
+    p_level_before INTEGER,
+    p_level_after INTEGER,
+    p_level_change INTEGER
+)
+RETURNS UUID
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_answer_id UUID;
+BEGIN
+    INSERT INTO answers (
+        question_id, user_id, answer_text, total_score,
+        clinical_accuracy_score, risk_assessment_score,
+        communication_score, efficiency_score,
+        ai_feedback, ai_model_used,
+        level_before, level_after, level_change
+    )
+    VALUES (
+        p_question_id, p_user_id, p_answer_text, p_total_score,
+        p_clinical_accuracy, p_risk_assessment,
+        p_communication, p_efficiency,
+        p_feedback, p_model,
+        p_level_before, p_level_after, p_level_change
+    )
+    RETURNING id INTO v_answer_id;
+
+    -- Running stats are derived from the stored row inside the upsert,
+    -- so concurrent gradings cannot lose increments to a stale read
+    INSERT INTO user_document_mastery (
+        user_id, document_id, current_level,
+        questions_answered, questions_correct, avg_score, last_active
+    )
+    VALUES (
+        p_user_id, p_document_id, p_level_after,
+        1, CASE WHEN p_total_score >= 7 THEN 1 ELSE 0 END, p_total_score, NOW()
+    )
+    ON CONFLICT (user_id, document_id) DO UPDATE SET
+        current_level = p_level_after,
+        questions_answered = user_document_mastery.questions_answered + 1,
+        questions_correct = user_document_mastery.questions_correct
+            + CASE WHEN p_total_score >= 7 THEN 1 ELSE 0 END,
+        avg_score = (user_document_mastery.avg_score * user_document_mastery.questions_answered
+            + p_total_score) / (user_document_mastery.questions_answered + 1),
+        last_active = NOW();
+
+    UPDATE questions SET was_answered = TRUE WHERE id = p_question_id;
+
+    RETURN v_answer_id;
+END;
+$$;
+
 -- Indexes for performance
-CREATE INDEX idx_chunks_embedding ON document_chunks 
-USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100);
+CREATE INDEX idx_chunks_embedding ON document_chunks
+USING ivfflat (embedding halfvec_cosine_ops) WITH (lists = 100);
 
 CREATE INDEX idx_chunks_document_id ON document_chunks(document_id);
+CREATE INDEX idx_chunks_doc_type ON document_chunks(document_id, chunk_type);
 CREATE INDEX idx_questions_user_id ON questions(user_id);
 CREATE INDEX idx_answers_user_id ON answers(user_id);